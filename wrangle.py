@@ -4,13 +4,19 @@
 # wrangle.py - Unpack javadoc JARs into a coherent multi-project structure.
 #
 
-import logging, os, re, subprocess, sys
+import json, logging, mmap, os, re, shutil, subprocess, sys, threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Sequence
 from urllib import request
-from xml.etree import ElementTree as ET
 from zipfile import ZipFile
 
+try:
+    # Prefer libxml2-backed parsing when available.
+    from lxml import etree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
+
 # -- Constants --
 
 scriptDir = Path(__file__).parent
@@ -19,7 +25,13 @@ siteBase = baseDir / "site"
 workBase = baseDir / "work"
 jarDir = baseDir / "jars"
 
-toplevel_html_docs = {
+# Marks unpacked javadoc whose links have all been rewritten.
+linksRewrittenMarker = ".links-rewritten"
+
+# Prefer the Maven Daemon when installed, to reuse one warm JVM across invocations.
+mvnCommand = "mvnd" if shutil.which("mvnd") else "mvn"
+
+toplevel_html_docs = frozenset({
     "about.html",
     "allclasses-frame.html",
     "allclasses-index.html",
@@ -39,7 +51,21 @@ toplevel_html_docs = {
     "package-tree.html",
     "package-use.html",
     "serialized-form.html"
-}
+})
+
+# Old version-agnostic javadoc.scijava.org links, e.g. javadoc.scijava.org/SciJava/.
+_LINK_RE = re.compile(rb"https?://javadoc\.(?:scijava\.org|imagej\.net)/[^/]*/")
+# Literal substring of every old link, far cheaper to search for than the regex.
+_LINK_HINT = b"javadoc."
+
+# HTML files larger than this are scanned for links via mmap, without reading them.
+_MMAP_THRESHOLD = 64 * 1024
+
+# Maximum number of buffers per writev call (IOV_MAX on Linux and macOS).
+_IOV_MAX = 1024
+
+# Maven invocations share a local repository, so run them one at a time.
+_mvnLock = threading.Lock()
 
 # -- Logging --
 
@@ -69,11 +95,13 @@ class XML:
     def __init__(self, source):
         if isinstance(source, str) and source.startswith('<'):
             # Parse XML from string.
-            # https://stackoverflow.com/a/18281386/1207769
-            self.tree = ET.ElementTree(ET.fromstring(source))
+            # Encode first, since lxml rejects str input with an encoding declaration.
+            data = source.encode()
         else:
-            # Parse XML from file.
-            self.tree = ET.parse(source)
+            # Parse XML from file, read in one go rather than fed incrementally.
+            data = Path(source).read_bytes()
+        # https://stackoverflow.com/a/18281386/1207769
+        self.tree = ET.ElementTree(ET.fromstring(data))
         XML._strip_ns(self.tree.getroot())
 
     def elements(self, path):
@@ -85,118 +113,208 @@ class XML:
         return None if len(el) == 0 else el[0].text
 
     @staticmethod
-    def _strip_ns(el):
+    def _strip_ns(root):
         """
         Remove namespace prefixes from elements and attributes.
         Credit: https://stackoverflow.com/a/32552776/1207769
         """
-        if el.tag.startswith("{"):
-            el.tag = el.tag[el.tag.find("}")+1:]
-        for k in list(el.attrib.keys()):
-            if k.startswith("{"):
-                k2 = k[k.find("}")+1:]
-                el.attrib[k2] = el.attrib[k]
-                del el.attrib[k]
-        for child in el:
-            XML._strip_ns(child)
+        for el in root.iter():
+            if not isinstance(el.tag, str):
+                # Comment or processing instruction (lxml only).
+                continue
+            if el.tag[0] == "{":
+                el.tag = el.tag.partition("}")[2]
+            if el.attrib:
+                for k in [k for k in el.attrib if k[0] == "{"]:
+                    el.attrib[k.partition("}")[2]] = el.attrib.pop(k)
 
 # -- Functions --
 
 def mkdirs(path):
     path.mkdir(parents=True, exist_ok=True)
 
-def readfile(path):
-    try:
-        with open(path) as f:
-            return f.readlines()
-    except Exception as e:
-        log.warning(f"Failed to read file {path}")
-        log.debug(e)
+def iter_html(root):
+    """
+    Yield a DirEntry for every HTML file beneath the given directory.
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_html(entry.path)
+            elif entry.name.endswith(".html") and entry.is_file():
+                yield entry
+
+def unzip(zipFile: Path, destDir: Path):
+    """
+    Extract the given ZIP archive into the destination folder.
+    Like ZipFile.extractall, but copies with a larger buffer,
+    and creates empty entries without reading them at all.
+    """
+    root = os.path.normpath(destDir)
+    with ZipFile(zipFile) as z:
+        for info in z.infolist():
+            # Refuse entries that would land outside the destination folder.
+            target = os.path.normpath(os.path.join(root, info.filename))
+            if not target.startswith(root + os.sep):
+                log.warning(f"Skipping unsafe entry {info.filename} in {zipFile}")
+                continue
+            target = Path(target)
+            if info.is_dir():
+                mkdirs(target)
+                continue
+            mkdirs(target.parent)
+            if info.file_size == 0:
+                target.touch()
+                continue
+            with z.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, min(info.file_size, 1024 * 1024))
 
 def writefile(path, lines=None, append=False):
     with open(path, "a" if append else "w") as f:
         if lines is not None:
             f.writelines(lines)
 
+def append_bytes(path, chunks):
+    """
+    Append the given byte strings to a file, with as few syscalls as possible.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        for i in range(0, len(chunks), _IOV_MAX):
+            batch = chunks[i:i + _IOV_MAX]
+            written = os.writev(fd, batch)
+            if written < sum(map(len, batch)):
+                # Partial write; finish the batch the slow way.
+                rest = b"".join(batch)[written:]
+                while rest:
+                    rest = rest[os.write(fd, rest):]
+    finally:
+        os.close(fd)
+
 def execute(cmd: Sequence[str], die_on_error=True):
-    result = subprocess.run(cmd, capture_output=True)
+    result = subprocess.run(cmd, capture_output=True, encoding="utf-8", errors="replace")
     if result.returncode != 0:
         error_message = f"Command {cmd[0]} failed with exit code {result.returncode}"
         if die_on_error:
-            die(error_message + ":\n" + result.stdout.decode())
+            die(error_message + ":\n" + result.stdout)
         else:
             raise RuntimeError(error_message)
-    return result.stdout.decode().splitlines(keepends=True)
+    return result.stdout.splitlines(keepends=True)
 
 def mvn(goal: Sequence[str], pom=None, die_on_error=True, **kwargs):
-    cmd = ["mvn", "-B", "-s", "settings.xml"]
+    cmd = [mvnCommand, "-B", "-s", "settings.xml"]
     if pom is not None:
         cmd.extend(["-f", str(pom)])
     cmd.append(goal)
     for k, v in kwargs.items():
         cmd.append(f"-D{k}={v}")
-    return execute(cmd, die_on_error=die_on_error)
+    with _mvnLock:
+        return execute(cmd, die_on_error=die_on_error)
 
 def squash(path: Path):
     if not Path(path).exists():
         log.info(f"Skipping squash of non-existent {path}")
         return
     try:
-        writefile(path, sorted(set(readfile(path))))
+        # Work on bytes: these index files are ASCII, so there is no need to decode.
+        # Line endings are normalized to \n, so CRLF and LF entries dedupe together.
+        with open(path, "rb") as f:
+            lines = set(f.read().splitlines())
+        with open(path, "wb") as f:
+            f.write(b"".join(line + b"\n" for line in sorted(lines)))
     except Exception as e:
         log.error(f"Exception squashing {path}")
         log.debug(e)
 
+def rewrite_links(path, newLink: bytes):
+    """
+    Replace old links in the given file, rewriting it only if any were found.
+    Returns the number of links replaced, or None if the file could not be processed.
+    """
+    try:
+        # Operate on raw bytes: older javadoc is not always UTF-8,
+        # and the link pattern is pure ASCII anyway.
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size > _MMAP_THRESHOLD:
+                # Scan large files in place, only copying them when there is a match.
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if m.find(_LINK_HINT) < 0 or _LINK_RE.search(m) is None:
+                        return 0
+                    data = m[:]
+            else:
+                data = f.read()
+                if _LINK_HINT not in data:
+                    return 0
+        newData, count = _LINK_RE.subn(newLink, data)
+        if count:
+            Path(path).write_bytes(newData)
+        return count
+    except Exception as e:
+        log.error(f"Exception replacing links for {path}")
+        log.debug(e)
+        return None
+
 def unpack_javadoc(c: GAV, jarFile: Path, javadocDir: Path):
-    if javadocDir.exists():
+    """
+    Unpack the javadoc JAR and glean its component's parent GAV.
+    Returns the parent GAV whose prefix the javadoc's links should be
+    rewritten to, or None if no link replacement should be done.
+    The caller is responsible for marking the links as rewritten afterward.
+    """
+    rewrittenMarker = javadocDir / linksRewrittenMarker
+    if rewrittenMarker.exists():
         log.info(f"Skipping already unpacked {c}")
-        return
+        return None
 
+    # Always (re-)extract: a folder without the marker may come from a run
+    # interrupted mid-extraction. Overwriting is idempotent, and rewriting
+    # links again is harmless, since rewritten links no longer match.
     log.info(f"Unpacking javadoc JAR for {c}")
     mkdirs(javadocDir)
-    with ZipFile(jarFile) as z:
-        z.extractall(javadocDir)
-
-    # Grab this component's associated POM.
-    log.info(f"Copying POM for {c}")
-    mvn("dependency:copy", artifact=f"{c}:pom", outputDirectory=javadocDir)
-
-    # Replace old javadoc.scijava.org links with new ones:
-    # javadoc.scijava.org/*/ -> javadoc.scijava.org/{parent.g}/{parent.a}/{parent.v}/
-    pom = javadocDir / f"{c.a}-{c.v}.pom"
-    xml = XML(pom)
-    parent = GAV(xml.value("parent/groupId"),
-                 xml.value("parent/artifactId"),
-                 xml.value("parent/version"))
+    unzip(jarFile, javadocDir)
+
+    # The parent GAV is recorded once gleaned, so resuming needs no POM.
+    parentFile = javadocDir / ".parent.json"
+    if parentFile.exists():
+        parent = GAV(**json.loads(parentFile.read_text()))
+    else:
+        # Grab this component's associated POM.
+        pom = javadocDir / f"{c.a}-{c.v}.pom"
+        if not pom.exists():
+            log.info(f"Copying POM for {c}")
+            mvn("dependency:copy", artifact=f"{c}:pom", outputDirectory=javadocDir)
+
+        xml = XML(pom)
+        parent = GAV(xml.value("parent/groupId"),
+                     xml.value("parent/artifactId"),
+                     xml.value("parent/version"))
+        parentFile.write_text(json.dumps({"g": parent.g, "a": parent.a, "v": parent.v}))
 
     if not parent.valid:
         log.warning(f"Could not glean parent POM for artifact {c}; skipping link replacement")
-        return
+        rewrittenMarker.touch()
+        return None
 
-    log.info(f"Replacing links for {c} javadoc")
-    oldLink = "https?://javadoc.(scijava.org|imagej.net)/[^/]*/"
-    newLink = f"/{parent.g}/{parent.a}/{parent.v}/"
-    for f in javadocDir.rglob("*"):
-        if f.suffix != '.html' or not f.is_file():
-            continue
-        try:
-            writefile(f, [re.sub(oldLink, newLink, line) for line in readfile(f)])
-        except Exception as e:
-            log.error(f"Exception replacing links for {f}")
-            log.debug(e)
+    return parent
 
+def process_component(c: GAV, bom: GAV, cachedJars: set):
+    """
+    Obtain and unpack the given component's javadoc.
+    The names of the files already in the JAR folder are given as cachedJars.
+    Returns the bytes this component contributes to each of the BOM's
+    aggregated index files, as lists of chunks keyed by file name.
+    """
+    indices = {}
 
-def process_component(c: GAV, bom: GAV, bomDir: Path):
     # Obtain the javadoc classifier JAR.
     jarFile = jarDir / f"{c.a}-{c.v}-javadoc.jar"
-    if not jarFile.exists():
+    if jarFile.name not in cachedJars:
         missingFile = jarFile.with_suffix(".missing")
-        if missingFile.exists():
+        if missingFile.name in cachedJars:
             log.warning(f"No javadoc archive for {c} (cached)")
-            return
+            return indices
 
         log.info(f"Downloading/copying javadoc archive: {jarFile.name}")
-        mkdirs(jarDir)
         try:
             mvn("dependency:copy", die_on_error=False,
                 artifact=f"{c}:jar:javadoc",
@@ -204,36 +322,63 @@ def process_component(c: GAV, bom: GAV, bomDir: Path):
         except RuntimeError as e:
             log.warning(f"No javadoc archive for {c}")
             log.debug(e)
-            writefile(missingFile)
-            return
+            missingFile.touch()
+            return indices
 
     # Unpack javadoc JAR into dedicated folder.
     javadocDir = siteBase / c.g / c.a / c.v
-    unpack_javadoc(c, jarFile, javadocDir)
+    parent = unpack_javadoc(c, jarFile, javadocDir)
 
     # Append this artifact's indices to the BOM's aggregated indices.
     log.info(f"Appending {c} package lists to {bom}")
     for packageIndexName in ("package-list", "element-list"):
         componentPackageIndex = javadocDir / packageIndexName
         if componentPackageIndex.exists():
-            bomPackageIndex = bomDir / packageIndexName
             try:
-                writefile(bomPackageIndex, readfile(componentPackageIndex), append=True)
+                # Normalize line endings, and terminate the last line, so that
+                # appended lists neither mix CRLF with LF nor run together.
+                lines = componentPackageIndex.read_bytes().splitlines()
+                indices[packageIndexName] = [b"".join(line + b"\n" for line in lines)]
             except Exception as e:
-                log.error(f"Exception appending {packageIndexName} for {c}")
+                log.warning(f"Failed to read file {componentPackageIndex}")
                 log.debug(e)
 
-    # Append artifact's class links to BOM folder's .htaccess redirects.
+    # Replace old javadoc.scijava.org links with new ones:
+    # javadoc.scijava.org/*/ -> javadoc.scijava.org/{parent.g}/{parent.a}/{parent.v}/
+    # And append artifact's class links to BOM folder's .htaccess redirects.
+    # Both are done in a single pass over the javadoc tree.
+    newLink = None
+    if parent is not None:
+        log.info(f"Replacing links for {c} javadoc")
+        newLink = f"/{parent.g}/{parent.a}/{parent.v}/".encode()
     log.info(f"Appending {c} htaccess rules to {bom}")
-    for f in javadocDir.rglob("*"):
+    redirects = []
+    linkCount = 0
+    failed = False
+    for entry in iter_html(javadocDir):
+        if newLink is not None:
+            count = rewrite_links(entry.path, newLink)
+            if count is None:
+                failed = True
+            else:
+                linkCount += count
         # Process only Java class and package HTML documents, not toplevel ones.
-        if f.suffix != '.html' or f.name in toplevel_html_docs or not f.is_file():
+        if entry.name in toplevel_html_docs:
             continue
-        relativePath = str(f)[len(str(javadocDir)):] # /
+        relativePath = entry.path[len(str(javadocDir)):] # /
         bomPath = f"/{bom.g}/{bom.a}/{bom.v}/{relativePath}"
         componentPath = f"/{c.g}/{c.a}/{c.v}/{relativePath}"
-        redirect = f"RedirectMatch permanent \"^{bomPath}$\" {componentPath}\n"
-        writefile(bomDir / ".htaccess", [redirect], append=True)
+        redirects.append(f"RedirectMatch permanent \"^{bomPath}$\" {componentPath}\n".encode())
+    indices[".htaccess"] = redirects
+    if newLink is not None:
+        log.debug(f"Replaced {linkCount} links in {c} javadoc")
+        if failed:
+            # Leave the marker absent, so the next run tries again.
+            log.warning(f"Link replacement incomplete for {c}; will retry next run")
+        else:
+            (javadocDir / linksRewrittenMarker).touch()
+
+    return indices
 
 def process_bom(bom: GAV):
     workDir = workBase / bom.g / bom.a / bom.v
@@ -262,26 +407,53 @@ def process_bom(bom: GAV):
     # Interpolate the BOM and extract the list of managed dependencies as XML.
     bomComponentsFile = workDir / "components.xml"
     if not bomComponentsFile.exists():
-        output = mvn("help:effective-pom", bomFile)
-        start = end = None
-        for i, line in enumerate(output):
-            if start is not None and end is not None: break
-            if line.startswith('  <dependencyManagement>'): start = i
-            elif line.startswith('  </dependencyManagement>'): end = i
-        if start is None or end is None:
-            die(f"Could not interpolate the BOM -- mvn output follows:\n{''.join(output)}")
-        writefile(bomComponentsFile, output[start:end+1])
+        effectivePomFile = workDir / "effective-pom.xml"
+        mvn("help:effective-pom", bomFile, output=effectivePomFile)
+        dependencyManagement = None
+        depth = 0
+        for event, el in ET.iterparse(str(effectivePomFile), events=("start", "end")):
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            # Only the project's own dependencyManagement, not a profile's.
+            if depth == 1 and el.tag.rpartition("}")[2] == "dependencyManagement":
+                dependencyManagement = el
+                break
+        if dependencyManagement is None:
+            die(f"Could not interpolate the BOM -- no dependencyManagement in {effectivePomFile}")
+        bomComponentsFile.write_bytes(ET.tostring(dependencyManagement))
     bomComponents = XML(bomComponentsFile)
 
+    # Deduplicate by GAV: the same component may be managed more than once
+    # (e.g. with a tests classifier), and must only be unpacked once.
+    components = {}
     for dep in bomComponents.elements('dependencies/dependency'):
         c = GAV(dep.find('groupId').text,
                 dep.find('artifactId').text,
                 dep.find('version').text)
         if c.valid:
-            process_component(c, bom, bomDir)
+            components.setdefault(str(c), c)
         else:
             log.warning(f"Invalid component: {c}")
 
+    # List already obtained (or known missing) javadoc JARs in one go,
+    # rather than checking for each component's files individually.
+    mkdirs(jarDir)
+    cachedJars = set(os.listdir(jarDir))
+
+    # Unpack the components' javadoc concurrently, then append their
+    # contributions to the BOM's aggregated indices from this thread only.
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        results = executor.map(lambda c: process_component(c, bom, cachedJars), components.values())
+        for c, indices in zip(components.values(), results):
+            for indexName, chunks in indices.items():
+                try:
+                    append_bytes(bomDir / indexName, chunks)
+                except Exception as e:
+                    log.error(f"Exception appending {indexName} for {c}")
+                    log.debug(e)
+
     # Sort package-list, element-list, and htaccess files, squashing duplicates.
     squash(bomDir / "package-list")
     squash(bomDir / "element-list")
@@ -341,8 +513,10 @@ def main(args=None):
 
     for arg in args:
         if ":" in arg:
-            gav = ":".split(arg)
-            bom = GAV(*gav)
+            parts = arg.split(":")
+            if len(parts) != 3 or not all(parts):
+                die(f"Invalid BOM {arg}; expected groupId:artifactId:version")
+            bom = GAV(*parts)
         else:
             bom = GAV("org.scijava", "pom-scijava", arg)
         process_bom(bom)